@@ -1,3 +1,9 @@
+# gevent: патчим сокеты до импорта requests/gspread, чтобы исходящие POST'ы не блокировали воркер
+from gevent import monkey
+monkey.patch_all()
+import gevent
+from gevent.pool import Pool
+
 import sys
 # Windows console UTF-8 (чтобы не было UnicodeEncodeError в PowerShell/ConEmu)
 try:
@@ -5,51 +11,221 @@ try:
 except Exception:
     pass
 
-from flask import Flask, request, jsonify
-from datetime import datetime
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import JSONProvider
+import orjson
+import msgspec
+from typing import Annotated
+from datetime import datetime, timedelta
 import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+from google.oauth2.service_account import Credentials
+from google.auth.transport.requests import AuthorizedSession, Request
+from google.auth import exceptions as google_auth_exceptions
 import requests
+import httpx
 import os
 import json
 import logging
-import csv
-from logging.handlers import RotatingFileHandler
+import time
+import queue
+import atexit
+import hashlib
+import secrets
+import functools
+import collections
+import threading
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from requests.adapters import HTTPAdapter
+from celery import Celery
+import redis
 
 # === FLASK ===
+class OrjsonProvider(JSONProvider):
+    """jsonify / request.get_json через orjson (C-парсер вместо stdlib json)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
-# === LOGGING (log.txt rotation up to 5MB) ===
+# === LOGGING (log.txt rotation up to 5MB; запись в файл — в отдельном потоке) ===
 handler = RotatingFileHandler("log.txt", maxBytes=5 * 1024 * 1024, backupCount=3)
 handler.setLevel(logging.INFO)
 formatter = logging.Formatter("%(asctime)s - %(levelname)s - %(message)s")
 handler.setFormatter(formatter)
-app.logger.addHandler(handler)
+log_queue = queue.Queue()
+app.logger.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, handler, respect_handler_level=True)
+log_listener.start()
+atexit.register(log_listener.stop)
 
 # === CONFIG (from environment) ===
 SLACK_WEBHOOK_URL = os.getenv("SLACK_WEBHOOK_URL")
 DISCORD_WEBHOOK_URL = os.getenv("DISCORD_WEBHOOK_URL")
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
+TELEGRAM_URL = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage" if TELEGRAM_TOKEN else None
 
 SHEET_ID = os.getenv("SHEET_ID")
 SHEET_NAME = os.getenv("SHEET_NAME", "Sheet1")
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON")
 CREDENTIALS_FILE = os.getenv("CREDENTIALS_FILE", "focus-automation-credentials.json")
+TOKEN_CACHE_FILE = os.getenv("TOKEN_CACHE_FILE", "/tmp/gs_token.json")
+
+REDIS_URL = os.getenv("REDIS_URL")
+
+# === TASK QUEUE (Celery; без REDIS_URL всё выполняется в процессе веб-сервера) ===
+celery_app = Celery("focus", broker=REDIS_URL)
+# transport-level only (gspread / notifiers); HTTP 4xx is permanent and never retried
+NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout, httpx.TransportError)
+TASK_OPTS = dict(bind=True, autoretry_for=NETWORK_ERRORS, retry_backoff=True, max_retries=5)
 
-# === GOOGLE SHEETS SETUP ===
+# === DEDUP (повторы клиента в течение DEDUP_TTL не доходят до Sheets/каналов) ===
+DEDUP_TTL = 60  # seconds
+R = redis.Redis.from_url(REDIS_URL, decode_responses=True, socket_timeout=1) if REDIS_URL else None
+
+def event_key(user, event) -> str:
+    # orjson-массив однозначен: ("a|b", "c") и ("a", "b|c") дают разные ключи
+    return "evt:" + hashlib.blake2b(orjson.dumps([user, event]), digest_size=8).hexdigest()
+
+def claim_event(key) -> bool:
+    """False if the same event was already accepted within DEDUP_TTL"""
+    if R is None:
+        return True
+    try:
+        return bool(R.set(key, "1", nx=True, ex=DEDUP_TTL))
+    except redis.RedisError as e:
+        app.logger.warning("Dedup check skipped: %s", e)
+        return True
+
+def release_event(key):
+    """Forget a claim so a retry of a rejected event is not treated as a duplicate"""
+    if R is None:
+        return
+    try:
+        R.delete(key)
+    except redis.RedisError as e:
+        app.logger.warning("Dedup release failed: %s", e)
+
+# === HTTP (общий пул соединений + гринлеты для параллельной отправки) ===
+# HTTP/2: все sendMessage/хуки к api.telegram.org, hooks.slack.com, discord.com
+# мультиплексируются поверх одного TCP+TLS соединения на хост
+HTTP_TIMEOUT = httpx.Timeout(5.0, connect=2.0)  # зависший хук не держит воркер
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+HTTP_RETRIES = 3
+HTTP = httpx.Client(
+    timeout=HTTP_TIMEOUT,
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,  # connect errors only
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=8, keepalive_expiry=60),
+    ),
+)
+NOTIFY_POOL = Pool(64)
+
+def post_json(url, payload):
+    """POST over the shared client, retrying read timeouts and 429/5xx with exponential backoff
+
+    Connect errors are retried by the transport; together this matches the old
+    urllib3 Retry(total=3, connect=2, read=2, allowed_methods=["POST"]).
+    """
+    for attempt in range(HTTP_RETRIES):
+        last = attempt == HTTP_RETRIES - 1
+        try:
+            r = HTTP.post(url, json=payload)
+        except httpx.ReadTimeout:
+            if last:
+                raise
+        else:
+            if r.status_code not in HTTP_RETRY_STATUSES or last:
+                return r
+        time.sleep(0.25 * 2 ** attempt)
+
+# === GOOGLE SHEETS SETUP (лениво: авторизация и metadata-запрос — при первом обращении) ===
 scope = ["https://www.googleapis.com/auth/spreadsheets"]
-try:
+SHEET_RETRY_AFTER = 60  # seconds between setup attempts after a failure
+SHEETS_TIMEOUT = (2, 10)  # (connect, read) seconds; по умолчанию у gspread таймаута нет
+_sheet = None
+_sheet_retry_at = 0.0
+_SHEET_LOCK = threading.Lock()
+
+def _load_cached_token(creds, key):
+    """Reuse an access token another worker already fetched, if it is still valid"""
+    try:
+        fd = os.open(TOKEN_CACHE_FILE, os.O_RDONLY | getattr(os, "O_NOFOLLOW", 0))
+        with open(fd, encoding="utf-8") as f:
+            st = os.fstat(fd)
+            # only trust a private file written by this user
+            if hasattr(os, "getuid") and (st.st_uid != os.getuid() or st.st_mode & 0o077):
+                return
+            cached = json.load(f)
+        if cached.get("key") != key:
+            return
+        expiry = datetime.strptime(cached["expiry"], "%Y-%m-%dT%H:%M:%S")
+        if expiry - datetime.utcnow() > timedelta(seconds=60):
+            creds.token = cached["token"]
+            creds.expiry = expiry
+    except (OSError, ValueError, KeyError):
+        pass
+
+def _save_cached_token(creds, key):
+    # bearer-токен: файл 0600, O_EXCL не идёт по чужим симлинкам в /tmp
+    tmp = f"{TOKEN_CACHE_FILE}.{os.getpid()}.{secrets.token_hex(4)}"
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump({
+                "key": key,
+                "token": creds.token,
+                "expiry": creds.expiry.strftime("%Y-%m-%dT%H:%M:%S"),
+            }, f)
+        os.replace(tmp, TOKEN_CACHE_FILE)
+    except (OSError, AttributeError) as e:
+        app.logger.warning("Token cache write warn: %s", e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+
+@functools.lru_cache(maxsize=1)
+def get_credentials():
+    """Service account credentials with a valid access token (disk-cached across workers)"""
     if GOOGLE_CREDENTIALS_JSON:
-        creds_info = json.loads(GOOGLE_CREDENTIALS_JSON)
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_info, scope)
+        raw = GOOGLE_CREDENTIALS_JSON
     else:
-        creds = ServiceAccountCredentials.from_json_keyfile_name(CREDENTIALS_FILE, scope)
-    client = gspread.authorize(creds)
-    sheet = client.open_by_key(SHEET_ID).worksheet(SHEET_NAME)
-except Exception as e:
-    app.logger.error(f"Google Sheets setup error: {e}", exc_info=True)
-    sheet = None
+        with open(CREDENTIALS_FILE, encoding="utf-8") as f:
+            raw = f.read()
+    creds = Credentials.from_service_account_info(orjson.loads(raw), scopes=scope)
+    key = hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+    _load_cached_token(creds, key)
+    if not creds.valid:
+        creds.refresh(Request())
+        _save_cached_token(creds, key)
+    return creds
+
+def get_sheet():
+    """Worksheet handle, opened once per process; None if Sheets is unavailable"""
+    global _sheet, _sheet_retry_at
+    if _sheet is not None or not SHEET_ID or time.monotonic() < _sheet_retry_at:
+        return _sheet
+    with _SHEET_LOCK:
+        if _sheet is None:
+            try:
+                creds = get_credentials()
+                # keep-alive к sheets.googleapis.com: один пул на все вызовы gspread
+                session = AuthorizedSession(creds, refresh_timeout=SHEETS_TIMEOUT[1])
+                session.mount("https://", HTTPAdapter(pool_maxsize=32))
+                client = gspread.Client(auth=creds, session=session)
+                client.set_timeout(SHEETS_TIMEOUT)
+                _sheet = client.open_by_key(SHEET_ID).worksheet(SHEET_NAME)
+            except Exception as e:
+                app.logger.error("Google Sheets setup error: %s", e, exc_info=True)
+                _sheet_retry_at = time.monotonic() + SHEET_RETRY_AFTER
+    return _sheet
 
 # === UTILS ===
 def client_ip(req) -> str:
@@ -59,116 +235,415 @@ def client_ip(req) -> str:
         return xff.split(",")[0].strip()
     return req.remote_addr
 
-def log_to_csv(user, event, ip_address, user_agent):
-    """Append events to CSV with простая ротация > 1MB"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_file = "events_log.csv"
+_ts_cache = (0, "")
+
+def now_str() -> str:
+    """Local time as 'YYYY-MM-DD HH:MM:SS'; strftime runs at most once per second"""
+    global _ts_cache
+    sec = int(time.time())
+    if _ts_cache[0] != sec:
+        _ts_cache = (sec, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(sec)))
+    return _ts_cache[1]
+
+# === CSV (очередь + один фоновый писатель, O_APPEND-дескриптор открыт постоянно) ===
+CSV_FILE = "events_log.csv"
+CSV_MAX_BYTES = 1 * 1024 * 1024
+CSV_BATCH = 128
+CSV_Q = queue.Queue()
+
+def _open_csv():
+    return os.open(CSV_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+def _follow_csv(fd):
+    """Reopen CSV_FILE if another process rotated it away from fd; returns (fd, size of CSV_FILE)"""
     try:
-        if os.path.exists(log_file) and os.path.getsize(log_file) > 1 * 1024 * 1024:
-            os.rename(log_file, f"events_log_{timestamp.replace(':', '-')}.bak.csv")
+        st = os.stat(CSV_FILE)
+        if st.st_ino == os.fstat(fd).st_ino:
+            return fd, st.st_size
+    except FileNotFoundError:
+        pass
+    os.close(fd)
+    fd = _open_csv()
+    return fd, os.fstat(fd).st_size
+
+def _csv_field(value) -> str:
+    s = "" if value is None else str(value)
+    if "," in s or '"' in s or "\n" in s or "\r" in s:
+        return '"' + s.replace('"', '""') + '"'
+    return s
+
+def _csv_line(row) -> str:
+    # same dialect as csv.writer's default: minimal quoting, \r\n line ends
+    return ",".join(map(_csv_field, row)) + "\r\n"
+
+def _csv_writer_loop():
+    fd = _open_csv()
+    running = True
+    while running:
+        batch = [CSV_Q.get()]
+        try:
+            while len(batch) < CSV_BATCH:
+                batch.append(CSV_Q.get_nowait())
+        except queue.Empty:
+            pass
+        if None in batch:  # stop sentinel from _stop_csv_writer
+            running = False
+            batch = [row for row in batch if row is not None]
+        # gunicorn-воркеры и celery пишут в один файл: дескриптор должен смотреть на текущий inode
+        fd, size = _follow_csv(fd)
+        try:
+            size += os.write(fd, "".join(map(_csv_line, batch)).encode("utf-8"))
+            for row in batch:
+                app.logger.info("CSV: %s | %s | %s | %s | %s", *row)
+        except Exception as e:
+            app.logger.error("CSV write error: %s", e, exc_info=True)
+        # простая ротация > 1MB по размеру файла (общему для всех процессов)
+        if size <= CSV_MAX_BYTES:
+            continue
+        try:
+            # другой процесс мог успеть сделать ротацию — тогда только переоткрываем
+            if os.stat(CSV_FILE).st_ino == os.fstat(fd).st_ino:
+                stamp = datetime.now().strftime("%Y-%m-%d %H-%M-%S-%f")[:-3]
+                os.rename(CSV_FILE, f"events_log_{stamp}_{os.getpid()}.bak.csv")
+        except Exception as e:
+            app.logger.warning("CSV rotation warn: %s", e)
+        os.close(fd)
+        fd = _open_csv()
+    os.close(fd)
+
+_csv_thread = threading.Thread(target=_csv_writer_loop, name="csv-writer", daemon=True)
+_csv_thread.start()
+
+@atexit.register
+def _stop_csv_writer():
+    CSV_Q.put(None)
+    _csv_thread.join(timeout=5)
+
+def log_to_csv(user, event, ip_address, user_agent, timestamp):
+    """Queue an event row for the background CSV writer"""
+    CSV_Q.put((timestamp, user, event, ip_address, user_agent))
+
+def is_transient(e) -> bool:
+    """Network errors and Sheets 429/5xx are worth retrying; anything else is permanent"""
+    if isinstance(e, gspread.exceptions.APIError):
+        status = getattr(getattr(e, "response", None), "status_code", None)
+        return status in HTTP_RETRY_STATUSES
+    # сбой сети при обновлении токена в AuthorizedSession приходит обёрнутым, не как requests-ошибка
+    return isinstance(e, NETWORK_ERRORS + (google_auth_exceptions.TransportError,))
+
+def retry_in_worker(task, e):
+    """Inside a Celery worker re-raise transient errors so the task is retried"""
+    if task.request.called_directly or not is_transient(e) or task.request.retries >= task.max_retries:
+        return
+    if isinstance(e, NETWORK_ERRORS):
+        raise e  # autoretry_for, с retry_backoff
+    raise task.retry(exc=e, countdown=min(2 ** task.request.retries, 60))
+
+# === SHEETS (строки копятся и уходят одним append_rows) ===
+SHEET_BATCH_SIZE = 50
+SHEET_FLUSH_INTERVAL = 2.0  # seconds
+SHEET_MAX_PENDING = 100 * SHEET_BATCH_SIZE
+SHEET_MAX_ATTEMPTS = 6  # per row, in-process flushes only (Celery has max_retries)
+SHEET_MAX_BACKOFF = 60  # seconds; квота Sheets считается поминутно
+_PENDING = collections.deque()  # [attempts, row]
+_PENDING_LOCK = threading.Lock()
+_flush_timer = None
+_flush_not_before = 0.0  # monotonic; inline flushes wait out the current backoff
+
+def _drop_rows(rows, reason):
+    for row in rows:
+        app.logger.error("Sheets row dropped (%s): %s", reason, row)
+
+def _sheets_backoff(attempt) -> float:
+    """2, 4, 8 … seconds, capped at SHEET_MAX_BACKOFF"""
+    return min(SHEET_FLUSH_INTERVAL * 2 ** attempt, SHEET_MAX_BACKOFF)
+
+def _retry_sheets_task(task, rows, reason, countdown):
+    """Celery worker: retry the batch later, or log every row once retries run out"""
+    if task.request.retries < task.max_retries:
+        raise task.retry(countdown=countdown)
+    _drop_rows(rows, f"{reason}; gave up after {task.max_retries} retries")
+
+@celery_app.task(**TASK_OPTS)
+def append_sheet_rows(self, rows):
+    if not SHEET_ID:
+        return {"ok": False, "error": "not_configured", "retry": False}
+    in_worker = not self.request.called_directly
+    sheet = get_sheet()
+    if not sheet:
+        # setup не удался; следующая попытка не раньше _sheet_retry_at
+        if in_worker:
+            _retry_sheets_task(self, rows, "unavailable", SHEET_RETRY_AFTER)
+        return {"ok": False, "error": "unavailable", "retry": True}
+    try:
+        sheet.append_rows(rows, value_input_option="RAW")
+        return {"ok": True, "rows": len(rows)}
     except Exception as e:
-        app.logger.warning(f"CSV rotation warn: {e}")
+        app.logger.error("Sheets append error: %s", e, exc_info=True)
+        if in_worker:
+            if is_transient(e):
+                _retry_sheets_task(self, rows, e, _sheets_backoff(self.request.retries + 1))
+            else:
+                _drop_rows(rows, e)
+        return {"ok": False, "error": str(e), "retry": is_transient(e)}
+
+def _schedule_flush(delay=SHEET_FLUSH_INTERVAL):
+    """Start the flush timer if none is pending (caller holds _PENDING_LOCK)"""
+    global _flush_timer
+    if _flush_timer is None:
+        _flush_timer = threading.Timer(delay, flush_sheet_rows)
+        _flush_timer.daemon = True
+        _flush_timer.start()
+
+def _trim_pending():
+    """Drop the oldest rows above SHEET_MAX_PENDING (caller holds _PENDING_LOCK)"""
+    overflow = [_PENDING.popleft()[1] for _ in range(len(_PENDING) - SHEET_MAX_PENDING)]
+    if overflow:
+        _drop_rows(overflow, "buffer full")
+
+def queue_sheet_row(row):
+    """Buffer a row; flush inline once SHEET_BATCH_SIZE rows are waiting"""
+    if not SHEET_ID:
+        return
+    with _PENDING_LOCK:
+        _PENDING.append([0, row])
+        _trim_pending()
+        full = len(_PENDING) >= SHEET_BATCH_SIZE and time.monotonic() >= _flush_not_before
+        if not full:
+            _schedule_flush()
+    if full:
+        flush_sheet_rows()
+
+def flush_sheet_rows():
+    global _flush_timer, _flush_not_before
+    with _PENDING_LOCK:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+        items = list(_PENDING)
+        _PENDING.clear()
+    if not items:
+        return
+    rows = [row for _, row in items]
     try:
-        with open(log_file, "a", newline="", encoding="utf-8") as f:
-            csv.writer(f).writerow([timestamp, user, event, ip_address, user_agent])
-        app.logger.info(f"CSV: {timestamp} | {user} | {event} | {ip_address} | {user_agent}")
+        if REDIS_URL:
+            append_sheet_rows.apply_async(args=[rows], queue="sheets")
+            return
+        res = append_sheet_rows(rows)
+        if res["ok"]:
+            return
+        retry, reason = res["retry"], res["error"]
     except Exception as e:
-        app.logger.error(f"CSV write error: {e}", exc_info=True)
+        app.logger.error("Sheets enqueue error: %s", e, exc_info=True)
+        retry, reason = True, e
+    if not retry:
+        _drop_rows(rows, reason)
+        return
+    # вернуть батч в начало очереди и попробовать позже
+    if reason == "unavailable":
+        # Sheets даже не пробовали — попытка не считается, ждём окончания SHEET_RETRY_AFTER
+        retry_items, dropped = items, []
+        delay = max(_sheet_retry_at - time.monotonic(), SHEET_FLUSH_INTERVAL)
+    else:
+        retry_items, dropped = [], []
+        for attempts, row in items:
+            if attempts + 1 >= SHEET_MAX_ATTEMPTS:
+                dropped.append(row)
+            else:
+                retry_items.append([attempts + 1, row])
+        delay = _sheets_backoff(max((a for a, _ in retry_items), default=0))
+    if dropped:
+        _drop_rows(dropped, f"{reason}; gave up after {SHEET_MAX_ATTEMPTS} attempts")
+    with _PENDING_LOCK:
+        _PENDING.extendleft(reversed(retry_items))
+        _trim_pending()
+        if _PENDING:
+            _flush_not_before = time.monotonic() + delay
+            _schedule_flush(delay)
+
+atexit.register(flush_sheet_rows)
 
 # === SENDERS ===
-def send_slack_message(text: str):
+@celery_app.task(**TASK_OPTS)
+def send_slack_message(self, text: str):
     if not SLACK_WEBHOOK_URL:
         app.logger.warning("SLACK_WEBHOOK_URL not configured")
         return {"ok": False, "error": "not_configured"}
     try:
-        r = requests.post(SLACK_WEBHOOK_URL, json={"text": text}, timeout=10)
-        return {"ok": r.ok, "status": r.status_code}
+        r = post_json(SLACK_WEBHOOK_URL, {"text": text})
+        return {"ok": r.is_success, "status": r.status_code}
+    except httpx.TimeoutException as e:
+        app.logger.warning("Slack send timeout: %s", e)
+        retry_in_worker(self, e)
+        return {"ok": False, "error": "timeout"}
     except Exception as e:
-        app.logger.error(f"Slack send error: {e}", exc_info=True)
+        app.logger.error("Slack send error: %s", e, exc_info=True)
+        retry_in_worker(self, e)
         return {"ok": False, "error": str(e)}
 
-def send_discord_message(text: str):
+@celery_app.task(**TASK_OPTS)
+def send_discord_message(self, text: str):
     if not DISCORD_WEBHOOK_URL:
         app.logger.warning("DISCORD_WEBHOOK_URL not configured")
         return {"ok": False, "error": "not_configured"}
     try:
-        r = requests.post(DISCORD_WEBHOOK_URL, json={"content": text}, timeout=10)
-        return {"ok": r.ok, "status": r.status_code}
+        r = post_json(DISCORD_WEBHOOK_URL, {"content": text})
+        return {"ok": r.is_success, "status": r.status_code}
+    except httpx.TimeoutException as e:
+        app.logger.warning("Discord send timeout: %s", e)
+        retry_in_worker(self, e)
+        return {"ok": False, "error": "timeout"}
     except Exception as e:
-        app.logger.error(f"Discord send error: {e}", exc_info=True)
+        app.logger.error("Discord send error: %s", e, exc_info=True)
+        retry_in_worker(self, e)
         return {"ok": False, "error": str(e)}
 
-def send_telegram_message(text: str):
+@celery_app.task(**TASK_OPTS)
+def send_telegram_message(self, text: str):
     if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
         app.logger.warning("Telegram not configured (TELEGRAM_TOKEN or TELEGRAM_CHAT_ID missing)")
         return {"ok": False, "error": "not_configured"}
-    url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
     try:
-        r = requests.post(url, json={"chat_id": TELEGRAM_CHAT_ID, "text": text}, timeout=10)
+        r = post_json(TELEGRAM_URL, {"chat_id": TELEGRAM_CHAT_ID, "text": text})
         # Telegram часто шлёт JSON-ответ; логируем коротко
         _ = r.json() if r.headers.get("content-type","").startswith("application/json") else r.text
-        r.raise_for_status()
-        return {"ok": True, "status": r.status_code}
+        return {"ok": r.is_success, "status": r.status_code}
+    except httpx.TimeoutException as e:
+        app.logger.warning("Telegram send timeout: %s", e)
+        retry_in_worker(self, e)
+        return {"ok": False, "error": "timeout"}
     except Exception as e:
-        app.logger.error(f"Telegram send error: {e}", exc_info=True)
+        app.logger.error("Telegram send error: %s", e, exc_info=True)
+        retry_in_worker(self, e)
         return {"ok": False, "error": str(e)}
 
+NOTIFIERS = {
+    "slack": send_slack_message,
+    "discord": send_discord_message,
+    "telegram": send_telegram_message,
+}
+
+# === EVENT QUEUE (обработка событий вне запроса) ===
+EVENT_Q = queue.Queue(maxsize=1000)  # полная очередь -> 503, клиент повторит позже
+EVENT_WORKERS = 4
+EVENT_DRAIN_TIMEOUT = 20  # seconds; below gunicorn's default graceful_timeout (30)
+
+def process_event(timestamp, user, event, ip_address, user_agent):
+    """Sheets + CSV + Slack/Discord/Telegram for one accepted event"""
+    # Google Sheets (best-effort, batched)
+    queue_sheet_row([timestamp, user, event, ip_address, user_agent])
+
+    # CSV (локальный файл — всегда в процессе веб-сервера)
+    log_to_csv(user, event, ip_address, user_agent, timestamp)
+
+    # Unified message to channels
+    msg = f"{user} triggered: {event} at {timestamp}"
+
+    # With a broker the Celery workers do the network I/O
+    if REDIS_URL:
+        for task in NOTIFIERS.values():
+            task.apply_async(args=[msg], queue="notify")
+        return
+
+    # Slack/Discord/Telegram in parallel; each send is bounded by HTTP_TIMEOUT
+    gevent.joinall([NOTIFY_POOL.spawn(fn, msg) for fn in NOTIFIERS.values()])
+
+def _run_event(item):
+    try:
+        process_event(*item)
+    except Exception as e:
+        app.logger.error("Event processing error: %s", e, exc_info=True)
+    finally:
+        EVENT_Q.task_done()
+
+def _event_worker_loop():
+    while True:
+        _run_event(EVENT_Q.get())
+
+for i in range(EVENT_WORKERS):
+    threading.Thread(target=_event_worker_loop, name=f"event-worker-{i}", daemon=True).start()
+
+@atexit.register
+def _drain_events():
+    """Finish queued and in-flight events (client already got 202) before Sheets/CSV shut down"""
+    while True:
+        try:
+            _run_event(EVENT_Q.get_nowait())
+        except queue.Empty:
+            break
+    # события, которые воркеры уже взяли из очереди, но ещё не обработали
+    deadline = time.monotonic() + EVENT_DRAIN_TIMEOUT
+    with EVENT_Q.all_tasks_done:
+        while EVENT_Q.unfinished_tasks:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                app.logger.error("Shutdown: %d events still in flight, giving up", EVENT_Q.unfinished_tasks)
+                return
+            EVENT_Q.all_tasks_done.wait(remaining)
+
+# === SCHEMA ===
+NonEmptyStr = Annotated[str, msgspec.Meta(min_length=1)]
+
+class Event(msgspec.Struct):
+    user: NonEmptyStr
+    event: NonEmptyStr
+
+EVENT_DECODER = msgspec.json.Decoder(Event)
+
 # === ROUTES ===
 @app.route("/webhook", methods=["POST"])
 def webhook():
-    """Main webhook — Sheets + CSV + Slack/Discord/Telegram"""
+    """Main webhook — validate, queue for Sheets + CSV + Slack/Discord/Telegram, 202"""
     try:
-        data = request.get_json(force=True)
-        user = data.get("user")
-        event = data.get("event")
+        try:
+            evt = EVENT_DECODER.decode(request.get_data())
+        except msgspec.DecodeError:  # includes ValidationError
+            return jsonify({"status": "error", "message": "Invalid JSON"}), 400
+        user, event = evt.user, evt.event
         ip_address = client_ip(request)
         user_agent = request.headers.get("User-Agent", "unknown")
 
-        if not user or not event:
-            return jsonify({"status": "error", "message": "Invalid JSON"}), 400
-
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # Google Sheets (best-effort)
-        if sheet:
-            try:
-                sheet.append_row([timestamp, user, event, ip_address, user_agent])
-            except Exception as e:
-                app.logger.error(f"Sheets append error: {e}", exc_info=True)
-
-        # CSV
-        log_to_csv(user, event, ip_address, user_agent)
+        # Retry storm: тот же user/event за последние DEDUP_TTL секунд — без I/O
+        key = event_key(user, event)
+        if not claim_event(key):
+            return jsonify({"status": "dup"}), 200
 
-        # Unified message to channels
-        msg = f"{user} triggered: {event} at {timestamp}"
+        timestamp = now_str()
 
-        slack_res = send_slack_message(msg)
-        disc_res  = send_discord_message(msg)
-        tg_res    = send_telegram_message(msg)
+        # Sheets/CSV/каналы — в фоне; клиенту достаточно знать, что событие принято
+        try:
+            EVENT_Q.put_nowait((timestamp, user, event, ip_address, user_agent))
+        except queue.Full:
+            release_event(key)
+            app.logger.warning("Event queue full, rejecting %s: %s", user, event)
+            return jsonify({"status": "error", "message": "Busy, retry later"}), 503
 
-        return jsonify({
-            "status": "success",
-            "slack": slack_res,
-            "discord": disc_res,
-            "telegram": tg_res
-        }), 200
+        return jsonify({"status": "queued"}), 202
 
     except Exception as e:
-        app.logger.error(f"Webhook error: {e}", exc_info=True)
+        app.logger.error("Webhook error: %s", e, exc_info=True)
         # попытка уведомить Slack об ошибке (если настроен)
         send_slack_message(f"Error: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
-@app.route("/health", methods=["GET"])
-def health():
-    """Service health check"""
-    return jsonify({
+HEALTH_TTL = 5  # seconds; балансировщик опрашивает часто, тело пересобираем не чаще
+
+@functools.lru_cache(maxsize=1)
+def _health_body(bucket) -> bytes:
+    return orjson.dumps({
         "status": "ok",
         "slack": bool(SLACK_WEBHOOK_URL),
         "discord": bool(DISCORD_WEBHOOK_URL),
         "telegram": bool(TELEGRAM_TOKEN and TELEGRAM_CHAT_ID),
-        "sheets": bool(sheet)
-    }), 200
+        # "настроено" (ID + ключ), без сетевых вызовов — сам лист открывает обработчик событий
+        "sheets": bool(SHEET_ID and (GOOGLE_CREDENTIALS_JSON or os.path.exists(CREDENTIALS_FILE))),
+        "queue": bool(REDIS_URL)
+    })
+
+@app.route("/health", methods=["GET"])
+def health():
+    """Service health check"""
+    return Response(_health_body(int(time.time() // HEALTH_TTL)), status=200, mimetype="application/json")
 
 @app.route("/debug/env", methods=["GET"])
 def debug_env():
@@ -176,16 +651,17 @@ def debug_env():
         return (v[:10] + "…") if v else None
 
     return jsonify({
-        "TELEGRAM_TOKEN_prefix": mask(os.getenv("TELEGRAM_TOKEN")),
-        "TELEGRAM_CHAT_ID": os.getenv("TELEGRAM_CHAT_ID"),
-        "SLACK_WEBHOOK_URL_set": bool(os.getenv("SLACK_WEBHOOK_URL")),
-        "DISCORD_WEBHOOK_URL_set": bool(os.getenv("DISCORD_WEBHOOK_URL")),
-        "SHEET_ID_set": bool(os.getenv("SHEET_ID")),
-        "GOOGLE_CREDENTIALS_JSON_loaded": bool(os.getenv("GOOGLE_CREDENTIALS_JSON")),
+        "TELEGRAM_TOKEN_prefix": mask(TELEGRAM_TOKEN),
+        "TELEGRAM_CHAT_ID": TELEGRAM_CHAT_ID,
+        "SLACK_WEBHOOK_URL_set": bool(SLACK_WEBHOOK_URL),
+        "DISCORD_WEBHOOK_URL_set": bool(DISCORD_WEBHOOK_URL),
+        "SHEET_ID_set": bool(SHEET_ID),
+        "REDIS_URL_set": bool(REDIS_URL),
+        "GOOGLE_CREDENTIALS_JSON_loaded": bool(GOOGLE_CREDENTIALS_JSON),
     }), 200
 
 
 # === MAIN ===
 if __name__ == "__main__":
-    print("Sheets/Slack/Discord/Telegram pipeline starting...")
+    app.logger.info("Sheets/Slack/Discord/Telegram pipeline starting...")
     app.run(port=5000, debug=True)
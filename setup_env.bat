@@ -9,6 +9,6 @@ python -m venv venv
 call venv\Scripts\activate
 python -m ensurepip
 python -m pip install --upgrade pip
-python -m pip install flask gspread oauth2client requests
+python -m pip install -r requirements.txt
 echo === Setup complete! ===
 pause
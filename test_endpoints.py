@@ -22,7 +22,7 @@ for name, method, endpoint, payload in tests:
         else:
             response = requests.post(url, json=payload)
 
-        status = "✅" if response.status_code == 200 else "❌"
+        status = "✅" if response.status_code in (200, 202) else "❌"
         print(f"{status} {name} → {response.status_code} {response.text[:100]}")
 
     except Exception as e: